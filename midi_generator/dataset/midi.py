@@ -1,18 +1,57 @@
 """Pytorch data loader for MIDI files"""
+import fcntl
+import functools
 import hashlib
+import json
 import os
 import pickle
+import struct
 from enum import Enum, auto
-from typing import Dict, List, Optional
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set, Tuple, Union
 
+import blosc
 import numpy as np
 import pypianoroll
-import tqdm
 from torch.utils.data import Dataset
+from tqdm.contrib.concurrent import process_map
 
 from midi_generator.utils.log import Log
 
 
+def _hash_key(key: Tuple) -> str:
+    """
+    Hash a cache key to a file name.
+    BLAKE2b of hashlib is used, since it is the fastest of hashlib for the short keys of cache,
+    even faster than SHA-256 with SHA-NI, and it needs no 3rd-party library such that blake3.
+
+    Parameters:
+        key: Tuple - cache key
+
+    Returns:
+        str - hexadecimal 128 bits BLAKE2b digest of the repr of the key
+    """
+    return hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+
+
+def _downsample_pianoroll(pianoroll: np.array, factor: int) -> np.array:
+    """
+    Downsample a pianoroll in time by taking the maximum velocity over each window of factor time steps.
+    For a binarized pianoroll, it is the union of the notes played in the window.
+    It runs as a single vectorized reduction, instead of a Python loop over the windows.
+
+    Parameters:
+        pianoroll: np.array - A pianoroll with shape of [time, pitch]
+        factor: int - the number of time steps merged into one time step
+
+    Returns:
+        np.array - A pianoroll with shape of [ceil(time / factor), pitch]
+    """
+    if factor == 1 or len(pianoroll) == 0:
+        return pianoroll
+
+    return np.maximum.reduceat(pianoroll, np.arange(0, len(pianoroll), factor), axis=0)
+
+
 class MIDIData:
     """
     MIDIData class to manage single MIDI file.
@@ -45,20 +84,47 @@ class MIDIData:
         PERCUSSIVE = auto()
         SOUND_EFFECTS = auto()
 
-    _multi_track: pypianoroll.Multitrack
-    _pianorolls: Dict[INSTRUMENT, np.array]
+    # program: int - [0, 127] that represents MIDI instruments.
+    # we briefly uses 128 / 8 instruments, so each INSTRUMENT covers 8 consecutive programs.
+    _PROGRAM_TO_INSTRUMENT = tuple(instrument for instrument in INSTRUMENT for _ in range(8))
+
+    # Blosc parameters for the pianoroll cache.
+    # pianorolls are sparse uint8 matrices, so bit-shuffled LZ4 compresses them well at high speed.
+    _CACHE_CNAME = "lz4"
+    _CACHE_CLEVEL = 5
+    _CACHE_SHUFFLE = blosc.BITSHUFFLE
+    # every section of the cache file is prefixed with its length as a little-endian uint64
+    _CACHE_LENGTH = struct.Struct("<Q")
 
-    def __init__(
+    _multi_track: pypianoroll.Multitrack
+    # np.array of dtype object with a slot for each INSTRUMENT, indexed by INSTRUMENT.value - 1.
+    # each slot has the pianoroll np.array of the instrument, or None if the instrument is not played.
+    # binary pianorolls are packed along pitch by np.packbits, i.e. 16 bytes of 128 bits for each time step.
+    _pianorolls: np.array
+    # get_instruments() computed lazily from _pianorolls
+    _sorted_instruments: Optional[List[INSTRUMENT]]
+    _binary: bool
+    _downsample: int
+    # None to extract all instruments
+    _allowed_instruments: Optional[FrozenSet[INSTRUMENT]]
+
+    def __init__(  # pylint: disable=too-many-arguments
         self,
         midi_path: Optional[str] = None,
         multi_track: Optional[pypianoroll.Multitrack] = None,
         cache_home: Optional[str] = None,
+        binary: bool = False,
+        downsample: int = 1,
+        instruments: Optional[Set[INSTRUMENT]] = None,
     ):
         """
         Parameters:
             midi_path: str - path to a MIDI file
             multi_track: pypianoroll.Multitrack - multi_track object storing entire song
             cache_home: Optional[str] - path to cache home
+            binary: bool - keep only whether each note is on as np.bool_ instead of the uint8 velocity
+            downsample: int - the number of time steps merged into one time step of the pianorolls
+            instruments: Optional[Set[INSTRUMENT]] - instruments to be extracted, None for all instruments
         Return:
             None
         """
@@ -68,8 +134,19 @@ class MIDIData:
         if midi_path is not None and multi_track is not None:
             Log.warning("MIDIData - both midi_path and multi_track are passed, ignore multi_track")
 
+        if downsample < 1:
+            raise ValueError(f"downsample of MIDIData should be a positive integer, but {downsample} is passed")
+
+        self._binary = binary
+        self._downsample = downsample
+        self._allowed_instruments = frozenset(instruments) if instruments is not None else None
+        self._sorted_instruments = None
+
+        # the cache path is looked up once for both of loading and storing the cache
+        cache_path = self._get_cache_path(midi_path=midi_path, cache_home=cache_home)
+
         # try to import the pianoroll of MIDI from the cache
-        self._pianorolls = self._try_pianorolls_from_cache(midi_path=midi_path, cache_home=cache_home)
+        self._pianorolls = self._try_pianorolls_from_cache(cache_path=cache_path)
 
         # cache miss
         if self._pianorolls is None:
@@ -79,98 +156,171 @@ class MIDIData:
                 multi_track = pypianoroll.read(midi_path)
 
             pianorolls = self._extract_pianorolls(multi_track=multi_track)
-            self._store_pianorolls_to_cache(midi_path=midi_path, cache_home=cache_home, pianorolls=pianorolls)
+            self._store_pianorolls_to_cache(cache_path=cache_path, pianorolls=pianorolls)
             self._pianorolls = pianorolls
 
-    def _get_cache_path(self, midi_path: str, cache_home: str):
+    def _cache_key(self, midi_path: str) -> Tuple:
         """
-        We store the pianoroll of MIDI by MD5 of MIDI path.
+        We key the pianoroll of MIDI by MIDI path, its modification time, its size, and the extraction options,
+        so the cache is invalidated when the MIDI file is modified.
 
         Parameters:
             midi_path: str - path to a MIDI file
-            cache_home: str - path to home of cache
 
         Returns:
-            str - {cache_home}/{md5 of MIDI path}.pkl
+            Tuple - (MIDI path, modification time in nanoseconds, size in bytes, binary, downsample,
+                sorted INSTRUMENT.value of instruments to be extracted or None for all instruments)
+        """
+        stat = os.stat(midi_path)
+        allowed_instruments = None
+        if self._allowed_instruments is not None:
+            allowed_instruments = tuple(sorted(instrument.value for instrument in self._allowed_instruments))
+
+        return (midi_path, stat.st_mtime_ns, stat.st_size, self._binary, self._downsample, allowed_instruments)
+
+    def _get_cache_path(self, midi_path: Optional[str], cache_home: Optional[str]) -> Optional[str]:
         """
-        cache_path = f"{cache_home}/{hashlib.md5(midi_path.encode()).hexdigest()}.pkl"
+        We store the pianoroll of MIDI by BLAKE2b hash of its cache key.
 
-        return cache_path
+        Parameters:
+            midi_path: Optional[str] - path to a MIDI file
+            cache_home: Optional[str] - path to home of cache
 
-    def _try_pianorolls_from_cache(self, midi_path: str, cache_home: str) -> Dict[INSTRUMENT, np.array]:
+        Returns:
+            str - {cache_home}/{blake2b of the cache key}.blosc
+            None - if the pianorolls are not cached, i.e. either of midi_path or cache_home is None
+        """
+        if cache_home is None or midi_path is None:
+            return None
+
+        return f"{cache_home}/{_hash_key(key=self._cache_key(midi_path=midi_path))}.blosc"
+
+    def _try_pianorolls_from_cache(self, cache_path: Optional[str]) -> Optional[np.array]:
         """
         Try to load the pianorolls of MIDI from cache.
-        We store the pianoroll of MIDI by MD5 of MIDI path.
-        the pianoroll object will be stored as .pkl
+        The cache file starts with the pickle (protocol 5) stream of the pianorolls slots,
+        followed by the out-of-band buffers of the pianorolls compressed by Blosc.
+        Each section is prefixed with its length.
+        A damaged cache file is a cache miss, so the MIDI is extracted again and the cache file is replaced.
 
         Parameters:
-            midi_path: str - path to a MIDI file
-            cache_home: str - path to home of cache
+            cache_path: Optional[str] - path to the cache file, see _get_cache_path
 
         Returns:
-            Dict[INSTRUMENT, np.array] - if cache hit, pianoroll of the MIDI
+            np.array - if cache hit, pianoroll slots of the MIDI
             None - if cache miss
         """
-        if cache_home is None:
+        if cache_path is None:
             return None
 
-        cache_path = self._get_cache_path(midi_path=midi_path, cache_home=cache_home)
-
-        if os.path.isfile(cache_path):
+        try:
             with open(cache_path, "rb") as f_cache:
-                pianorolls = pickle.load(f_cache)
-            return pianorolls
+                body = memoryview(f_cache.read())
+        except FileNotFoundError:
+            return None
 
-        return None
+        try:
+            sections = []
+            offset = 0
+            while offset < len(body):
+                (nbytes,) = self._CACHE_LENGTH.unpack_from(body, offset)
+                offset += self._CACHE_LENGTH.size
+                sections.append(body[offset : offset + nbytes])
+                offset += nbytes
+
+            # the last section is truncated if it ends beyond the cache file
+            if offset != len(body) or not sections:
+                return None
+
+            # np.array of pianorolls are rebuilt on top of the decompressed buffers without a copy
+            buffers = [blosc.decompress(section, as_bytearray=True) for section in sections[1:]]
+            pianorolls = pickle.loads(sections[0], buffers=buffers)
+        except (struct.error, blosc.blosc_extension.error, pickle.UnpicklingError, EOFError):
+            return None
+
+        return pianorolls
 
-    def _store_pianorolls_to_cache(
-        self, midi_path: str, cache_home: str, pianorolls: Dict[INSTRUMENT, np.array]
-    ) -> None:
+    def _store_pianorolls_to_cache(self, cache_path: Optional[str], pianorolls: np.array) -> None:
         """
         Store the pianorolls of MIDI to cache.
 
         Parameters:
-            midi_path: str - path to a MIDI file
-            cache_home: str - path to home of cache
-            pianorolls: Dict[INSRUMENT, np.array] - A dictionary of pianoroll mapping INSTRUMENT to pianoroll np.array
+            cache_path: Optional[str] - path to the cache file, see _get_cache_path
+            pianorolls: np.array - pianoroll slots indexed by INSTRUMENT.value - 1
 
         Returns:
             None
         """
-        if cache_home is None:
+        if cache_path is None:
             return
 
-        cache_path = self._get_cache_path(midi_path=midi_path, cache_home=cache_home)
-
-        # makedir if necessary
-        if not os.path.isdir(os.path.dirname(cache_path)):
-            os.makedirs(os.path.dirname(cache_path))
-
-        with open(cache_path, "wb+") as f_cache:
-            pickle.dump(pianorolls, f_cache)
-
-    def _extract_pianorolls(self, multi_track: pypianoroll.Multitrack) -> Dict[INSTRUMENT, np.array]:
+        # np.array of pianorolls are passed to buffer_callback as PickleBuffer instead of being copied into the stream
+        buffers: List[pickle.PickleBuffer] = []
+        stream = pickle.dumps(pianorolls, protocol=5, buffer_callback=buffers.append)
+
+        sections = [stream]
+        for buffer in buffers:
+            view = memoryview(buffer)
+            sections.append(
+                blosc.compress(
+                    buffer.raw(),
+                    typesize=view.itemsize,
+                    clevel=self._CACHE_CLEVEL,
+                    shuffle=self._CACHE_SHUFFLE,
+                    cname=self._CACHE_CNAME,
+                )
+            )
+
+        # the cache file is written to a temporary file of this process, and replaced atomically,
+        # so an interrupted write or other processes sharing cache_home never see a partial cache file
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        try:
+            f_cache = open(tmp_path, "wb")  # pylint: disable=consider-using-with
+        except FileNotFoundError:
+            # cache_home is created once by MIDIDataset, so it only happens on the first MIDIData of a new cache_home
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            f_cache = open(tmp_path, "wb")  # pylint: disable=consider-using-with
+
+        try:
+            with f_cache:
+                for section in sections:
+                    f_cache.write(self._CACHE_LENGTH.pack(len(section)))
+                    f_cache.write(section)
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def _extract_pianorolls(self, multi_track: pypianoroll.Multitrack) -> np.array:
         """
         Extract the pianorolls of MIDI from the multi_track.
         Each instrument has thier own pianoroll np.array of shape (-1, 128) representing (time, pitch).
+        The pianoroll is a contiguous uint8 velocity array, or a bit-packed uint8 array of shape (-1, 16) if binary.
+        Tracks of instruments not to be extracted are skipped before their pianorolls are touched.
 
         Parameters:
             multi_track: pypianorooll.Multitrack - A multi_track to be parsed to pianoroll
 
         Returns:
-            Dict[INSRUMENT, np.array] - A dictionary of pianoroll mapping INSTRUMENT to pianoroll np.array
+            np.array - pianoroll slots indexed by INSTRUMENT.value - 1, None for instruments not played
         """
-        pianorolls: Dict[MIDIData.INSTRUMENT, np.array] = {}
+        pianorolls = np.full(len(MIDIData.INSTRUMENT), None, dtype=object)
         track: pypianoroll.Track
         for track in multi_track.tracks:
-            # program: int - [0, 127] that represents MIDI instruments.
-            # we briefly uses 128 / 8 instruments by dividing program by 8
-            # note that the index of Enum starts from 1
-            instrument = MIDIData.INSTRUMENT(track.program / 8 + 1)
-            if instrument in pianorolls:
+            # look up the table instead of constructing INSTRUMENT(program // 8 + 1) for every track
+            instrument = MIDIData._PROGRAM_TO_INSTRUMENT[track.program]
+            if self._allowed_instruments is not None and instrument not in self._allowed_instruments:
+                continue
+
+            if pianorolls[instrument.value - 1] is not None:
                 Log.warning("Duplicated instruments found! we ignore the latter")
                 continue
-            pianorolls[instrument] = track.pianoroll
+
+            # velocities are in [0, 127], so uint8 keeps the pianoroll losslessly
+            pianoroll = _downsample_pianoroll(np.ascontiguousarray(track.pianoroll, dtype=np.uint8), self._downsample)
+            if self._binary:
+                pianoroll = np.packbits(pianoroll > 0, axis=1)
+            pianorolls[instrument.value - 1] = pianoroll
 
         return pianorolls
 
@@ -184,11 +334,35 @@ class MIDIData:
         Returns:
             List[MIDIData.INSTRUMENT] - A list of instruments sorted in the accending order of Enum
         """
-        return sorted(list(self._pianorolls.keys()))
+        if self._sorted_instruments is None:
+            self._sorted_instruments = [
+                instrument
+                for instrument, pianoroll in zip(MIDIData.INSTRUMENT, self._pianorolls)
+                if pianoroll is not None
+            ]
+
+        return self._sorted_instruments
+
+    def _get_slot(self, instrument: INSTRUMENT) -> np.array:
+        """
+        Get the stored pianoroll np.array for an instrument played in the track
+
+        Parameters:
+            instrument: INSTRUMENT - Enum value representing an instrument
+
+        Returns:
+            np.array - A pianoroll as stored in _pianorolls
+        """
+        pianoroll = self._pianorolls[instrument.value - 1]
+        if pianoroll is None:
+            raise KeyError(instrument)
+
+        return pianoroll
 
     def get_pianoroll(self, instrument: INSTRUMENT) -> np.array:
         """
-        Get a pianoroll np.array for an instrument played in the track
+        Get a pianoroll np.array for an instrument played in the track.
+        A binary pianoroll is unpacked from its bits on every call.
 
         Parameters:
             instrument: INSTRUMENT - Enum value representing an instrument
@@ -196,71 +370,500 @@ class MIDIData:
         Returns:
             np.array - A pianoroll with shape of [time, pitch]
         """
-        return self._pianorolls[instrument]
+        pianoroll = self._get_slot(instrument=instrument)
+
+        if self._binary:
+            return np.unpackbits(pianoroll, axis=1, count=128).view(np.bool_)
+
+        return pianoroll
+
+    def get_packed_pianoroll(self, instrument: INSTRUMENT) -> np.array:
+        """
+        Get a bit-packed binary pianoroll np.array for an instrument played in the track.
+        Each time step is 16 bytes of 128 pitch bits, so bitwise operations over pianorolls,
+        e.g. np.bitwise_or.reduce for the union of instruments, run on 8x less bytes.
+
+        Parameters:
+            instrument: INSTRUMENT - Enum value representing an instrument
+
+        Returns:
+            np.array - A uint8 pianoroll with shape of [time, 16], packed from [time, pitch] by np.packbits
+        """
+        pianoroll = self._get_slot(instrument=instrument)
+
+        if self._binary:
+            return pianoroll
+
+        return np.packbits(pianoroll > 0, axis=1)
+
+
+def _load_midi_data(
+    midi_path: str,
+    cache_home: Optional[str],
+    binary: bool,
+    downsample: int,
+    instruments: Optional[Set[MIDIData.INSTRUMENT]],
+) -> Optional[MIDIData]:
+    """
+    Load a MIDIData in a worker process of MIDIDataset.
+
+    Parameters:
+        midi_path: str - path to a MIDI file
+        cache_home: Optional[str] - path to cache home
+        binary: bool - whether the pianorolls are binarized
+        downsample: int - the number of time steps merged into one time step of the pianorolls
+        instruments: Optional[Set[MIDIData.INSTRUMENT]] - instruments to be extracted, None for all instruments
+
+    Returns:
+        MIDIData - if the MIDI is loaded
+        None - if the MIDI is unable to be parsed
+    """
+    try:
+        return MIDIData(
+            midi_path=midi_path,
+            cache_home=cache_home,
+            binary=binary,
+            downsample=downsample,
+            instruments=instruments,
+        )
+    except ValueError as exception:
+        Log.warning("Error while loading %s - skip this file: %s", midi_path, exception)
+        return None
+
+
+def _instrument_mask(instruments: Iterable[MIDIData.INSTRUMENT]) -> int:
+    """
+    Get a bit mask of instruments, which has the bit of (INSTRUMENT.value - 1) for each instrument.
+    All 16 instruments fit in np.uint16.
+
+    Parameters:
+        instruments: Iterable[MIDIData.INSTRUMENT] - instruments to be masked
+
+    Returns:
+        int - bit mask of the instruments
+    """
+    mask = 0
+    for instrument in instruments:
+        mask |= 1 << (instrument.value - 1)
+
+    return mask
+
+
+def _load_midi_instrument_mask(
+    midi_path: str,
+    cache_home: Optional[str],
+    binary: bool,
+    downsample: int,
+    instruments: Optional[Set[MIDIData.INSTRUMENT]],
+) -> Optional[int]:
+    """
+    Load a MIDIData in a worker process of a lazy MIDIDataset, and return only the mask of its instruments.
+    The pianorolls are not sent back to the dataset, but they are stored to the cache if cache_home is given.
+
+    Parameters:
+        midi_path: str - path to a MIDI file
+        cache_home: Optional[str] - path to cache home
+        binary: bool - whether the pianorolls are binarized
+        downsample: int - the number of time steps merged into one time step of the pianorolls
+        instruments: Optional[Set[MIDIData.INSTRUMENT]] - instruments to be extracted, None for all instruments
+
+    Returns:
+        int - if the MIDI is loaded, bit mask of instruments played in the MIDI
+        None - if the MIDI is unable to be parsed
+    """
+    midi_data = _load_midi_data(
+        midi_path=midi_path,
+        cache_home=cache_home,
+        binary=binary,
+        downsample=downsample,
+        instruments=instruments,
+    )
+    if midi_data is None:
+        return None
+
+    return _instrument_mask(instruments=midi_data.get_instruments())
+
+
+class _ConsolidatedStore:
+    """
+    A single append-only store of stacked pianorolls, shared by all MIDI files in a cache home.
+
+    {cache_home}/consolidated.bin has the raw bytes of the stacked pianorolls back to back,
+    and {cache_home}/consolidated.json indexes them by key to the offset, the shape and the dtype.
+    The data file is memory-mapped once, and each stacked pianoroll is a view of it.
+    Processes sharing the cache home, e.g. DDP ranks building the same dataset, append under a lock of the data file.
+    """
+
+    _data_path: str
+    _index_path: str
+    _index: Dict[str, Tuple[int, List[int], str]]
+    _memmap: Optional[np.array]
+
+    def __init__(self, cache_home: str):
+        """
+        Parameters:
+            cache_home: str - path to cache home
+        """
+        self._data_path = f"{cache_home}/consolidated.bin"
+        self._index_path = f"{cache_home}/consolidated.json"
+
+        self._index = self._read_index()
+        self._memmap = self._map()
+
+    def _read_index(self) -> Dict[str, Tuple[int, List[int], str]]:
+        """
+        Read the index file.
+
+        Returns:
+            Dict[str, Tuple[int, List[int], str]] - offset, shape and dtype of the stacked pianorolls by their keys,
+                empty if the index file is missing or damaged
+        """
+        try:
+            with open(self._index_path, "r", encoding="utf-8") as f_index:
+                return json.load(f_index)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    @staticmethod
+    def _end_of(entry: Tuple[int, List[int], str]) -> int:
+        """
+        Get the end offset of an entry of the index in the data file.
+
+        Parameters:
+            entry: Tuple[int, List[int], str] - offset, shape and dtype of a stacked pianoroll
+
+        Returns:
+            int - offset of the byte next to the stacked pianoroll
+        """
+        offset, shape, dtype = entry
+
+        return offset + int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+    def _map(self) -> Optional[np.array]:
+        """
+        Memory-map the data file.
 
+        Returns:
+            np.array - copy-on-write mapping of the data file as uint8
+            None - if the data file is empty
+        """
+        if not os.path.isfile(self._data_path) or os.path.getsize(self._data_path) == 0:
+            return None
+
+        # copy-on-write mapping gives a writable array to torch while sharing the page cache over workers
+        return np.memmap(self._data_path, dtype=np.uint8, mode="c")
+
+    def get(self, key: str) -> Optional[np.array]:
+        """
+        Get a stacked pianoroll from the store.
+
+        Parameters:
+            key: str - key of the stacked pianoroll
+
+        Returns:
+            np.array - if found, a view of the memory-mapped stacked pianoroll
+            None - if not found, or the data file is missing or truncated under the entry
+        """
+        if key not in self._index or self._memmap is None:
+            return None
 
-class MIDIDataset(Dataset):
+        offset, shape, dtype = self._index[key]
+        end = self._end_of(entry=self._index[key])
+        if end > len(self._memmap):
+            return None
+
+        return self._memmap[offset:end].view(dtype).reshape(shape)
+
+    def append(self, stacked: Dict[str, np.array]) -> None:
+        """
+        Append stacked pianorolls to the store.
+        The index is replaced after the data is written, so an interrupted append leaves only unindexed bytes.
+        Both are done under an exclusive lock of the data file, and the index is re-read under the lock,
+        so the entries appended by other processes meanwhile are kept.
+
+        Parameters:
+            stacked: Dict[str, np.array] - stacked pianorolls by their keys
+
+        Returns:
+            None
+        """
+        if not stacked:
+            return
+
+        with open(self._data_path, "ab") as f_data:
+            # the lock is released when the data file is closed
+            fcntl.flock(f_data, fcntl.LOCK_EX)
+
+            offset = os.fstat(f_data.fileno()).st_size
+            # entries beyond the end of a truncated data file would overlap the appended data
+            index = {key: entry for key, entry in self._read_index().items() if self._end_of(entry=entry) <= offset}
+
+            for key, pianoroll in stacked.items():
+                # already appended by another process
+                if key in index:
+                    continue
+
+                pianoroll = np.ascontiguousarray(pianoroll)
+                index[key] = (offset, list(pianoroll.shape), pianoroll.dtype.str)
+                pianoroll.tofile(f_data)
+                offset += pianoroll.nbytes
+            f_data.flush()
+
+            with open(f"{self._index_path}.tmp", "w", encoding="utf-8") as f_index:
+                json.dump(index, f_index)
+            os.replace(f"{self._index_path}.tmp", self._index_path)
+
+        self._index = index
+        self._memmap = self._map()
+
+
+class MIDIDataset(Dataset):  # pylint: disable=too-many-instance-attributes
     """
     Pytorch Dataset implementation for MIDI data
+
+    If cache_home is given, the stacked pianorolls of shape [time, pitch, # instruments] are consolidated
+    to a single store in cache_home at the first build, and memory-mapped at the later builds.
+    If binary, the pianorolls are stacked bit-packed along pitch, and unpacked on __getitem__.
+
+    If lazy, only the paths of MIDI files are kept, and each MIDI is loaded on __getitem__.
     """
 
-    _midis: List[MIDIData]
+    _paths: List[str]
+    # np.uint16 bit masks of instruments played in each MIDI, see _instrument_mask
+    _instrument_masks: np.array
+    # None if lazy
+    _stacked: Optional[List[np.array]]
+    _store: Optional[_ConsolidatedStore]
     _instruments: List[MIDIData.INSTRUMENT]
+    _cache_home: Optional[str]
+    _binary: bool
+    _downsample: int
 
-    def __init__(
+    def __init__(  # pylint: disable=too-many-arguments
         self,
         midi_files: List[str],
         instruments: List[MIDIData.INSTRUMENT],
         cache_home: Optional[str] = None,
+        binary: bool = False,
+        downsample: int = 1,
+        lazy: bool = False,
     ):
         """
         Parameters:
             midif_files: List[str] - A list of midi file paths
             instruments: List[MIDIData.INSTRUMENT]) - A list of instruments to be utilized on the futher processes
             cache_home: Optional[str] - path to cache home
+            binary: bool - serve np.bool_ pianorolls of note on/off instead of uint8 velocities
+            downsample: int - the number of time steps merged into one time step of the pianorolls
+            lazy: bool - load each MIDI on __getitem__ instead of keeping all pianorolls from the construction
         """
         Dataset.__init__(self)
 
-        self._midis = []
-        for midi_path in tqdm.tqdm(midi_files, desc="Loading MIDI files"):
-            try:
-                midi_data = MIDIData(midi_path=midi_path, cache_home=cache_home)
-            except ValueError as exception:
-                midi_data = None
-                Log.warning(f"Error while loading {midi_path} - skip this file: {exception}")
+        # checked here before loading, since MIDIData raising ValueError in the workers only skips each MIDI file
+        if downsample < 1:
+            raise ValueError(f"downsample of MIDIDataset should be a positive integer, but {downsample} is passed")
 
-            if midi_data is None:
-                continue
+        self._instruments = instruments
+        self._cache_home = cache_home
+        self._binary = binary
+        self._downsample = downsample
+
+        # cache_home is created here once, rather than on every cache write of MIDIData
+        if cache_home is not None:
+            os.makedirs(cache_home, exist_ok=True)
+
+        # a lazy dataset never stacks, so it does not use the consolidated cache.
+        self._store = _ConsolidatedStore(cache_home=cache_home) if cache_home is not None and not lazy else None
+
+        # the consolidated key and the memory-mapped stacked pianoroll of each MIDI file, see _try_consolidated_cache.
+        # keys are computed once here, so they are consistent even if a MIDI file is modified during the loading.
+        cached = [self._try_consolidated_cache(midi_path=midi_path) for midi_path in midi_files]
+
+        self._paths = []
+        instrument_masks = []
+        # stacked keeps the order of MIDI files with their keys, and has the loaded MIDIData if not stacked yet.
+        stacked: List[Tuple[Optional[str], Union[np.array, MIDIData]]] = []
+        loaded = iter(
+            self._load_midi_files(
+                midi_paths=[midi_path for midi_path, (_, memmap) in zip(midi_files, cached) if memmap is None],
+                lazy=lazy,
+            )
+        )
+        for midi_path, (key, memmap) in zip(midi_files, cached):
+            if memmap is not None:
+                # the consolidated cache only has MIDI files with all instruments of the dataset
+                instrument_masks.append(_instrument_mask(instruments=self._instruments))
+                stacked.append((key, memmap))
+            else:
+                result = next(loaded)
+                # the MIDI is unable to be parsed, skip this file
+                if result is None:
+                    continue
 
-            self._midis.append(midi_data)
+                if lazy:
+                    instrument_masks.append(result)
+                else:
+                    instrument_masks.append(_instrument_mask(instruments=result.get_instruments()))
+                    stacked.append((key, result))
 
-        self._instruments = instruments
+            self._paths.append(midi_path)
 
+        self._instrument_masks = np.array(instrument_masks, dtype=np.uint16)
         self.validate_data()
 
+        # pianorolls are served from the stacked arrays from now on
+        self._stacked = None
+        if self._store is not None:
+            self._stacked = self._consolidate_cache(stacked=stacked)
+        elif not lazy:
+            self._stacked = [self._stack_pianorolls(midi=midi) for _, midi in stacked]
+
+    def _load_midi_files(self, midi_paths: List[str], lazy: bool) -> List[Optional[Union[MIDIData, int]]]:
+        """
+        Load MIDI files in worker processes.
+        Parsing MIDI files is CPU-bound and independent for each file.
+        The progress bar is refreshed in coarse steps, since it is costly compared to loading a cached MIDI.
+
+        Parameters:
+            midi_paths: List[str] - A list of midi file paths
+            lazy: bool - get only the masks of instruments from the workers to validate the MIDI files
+
+        Returns:
+            List[Optional[Union[MIDIData, int]]] - MIDIData, or the mask of its instruments if lazy,
+                for each MIDI file in the same order. None if the MIDI is unable to be parsed.
+        """
+        if not midi_paths:
+            return []
+
+        return process_map(
+            functools.partial(
+                _load_midi_instrument_mask if lazy else _load_midi_data,
+                cache_home=self._cache_home,
+                binary=self._binary,
+                downsample=self._downsample,
+                instruments=set(self._instruments),
+            ),
+            midi_paths,
+            max_workers=os.cpu_count(),
+            chunksize=8,
+            desc="Loading MIDI files",
+            miniters=max(1, len(midi_paths) // 200),
+            mininterval=0.5,
+            smoothing=0,
+        )
+
+    def _stack_pianorolls(self, midi: MIDIData) -> np.array:
+        """
+        Stack the pianorolls of the instruments of the dataset once, so __getitem__ does not copy them on every access.
+        Binary pianorolls are stacked as packed by MIDIData, so the stack and the consolidated store are 8x smaller.
+
+        Parameters:
+            midi: MIDIData - MIDI to be stacked
+
+        Returns:
+            np.array - A pianoroll np.array with the shape of [time, pitch, # instruments],
+                or the uint8 shape of [time, 16, # instruments] packed along pitch if binary
+        """
+        if self._binary:
+            pianorolls = [midi.get_packed_pianoroll(instrument=instrument) for instrument in self._instruments]
+        else:
+            pianorolls = [midi.get_pianoroll(instrument=instrument) for instrument in self._instruments]
+
+        return np.stack(pianorolls, axis=2)
+
+    def _get_consolidated_key(self, midi_path: str) -> str:
+        """
+        We store the stacked pianoroll of MIDI by BLAKE2b hash of MIDI path, its modification time, its size,
+        and the instruments, the layout of the stacked pianoroll and downsample of the dataset.
+
+        Parameters:
+            midi_path: str - path to a MIDI file
+
+        Returns:
+            str - blake2b of MIDI, instruments, layout and downsample
+        """
+        stat = os.stat(midi_path)
+        key = (
+            midi_path,
+            stat.st_mtime_ns,
+            stat.st_size,
+            [instrument.name for instrument in self._instruments],
+            "packed" if self._binary else "velocity",
+            self._downsample,
+        )
+
+        return _hash_key(key=key)
+
+    def _try_consolidated_cache(self, midi_path: str) -> Tuple[Optional[str], Optional[np.array]]:
+        """
+        Try to get the memory-mapped stacked pianoroll of MIDI from the consolidated store.
+
+        Parameters:
+            midi_path: str - path to a MIDI file
+
+        Returns:
+            Tuple[Optional[str], Optional[np.array]] - the consolidated key of MIDI, None if no consolidated store,
+                and the memory-mapped stacked pianoroll, see _stack_pianorolls, None if cache miss
+        """
+        if self._store is None:
+            return None, None
+
+        key = self._get_consolidated_key(midi_path=midi_path)
+
+        return key, self._store.get(key=key)
+
+    def _consolidate_cache(self, stacked: List[Tuple[str, Union[np.array, MIDIData]]]) -> List[np.array]:
+        """
+        Append the stacked pianorolls of loaded MIDIData to the consolidated store,
+        and replace them with memory-mapped arrays.
+
+        Parameters:
+            stacked: List[Tuple[str, Union[np.array, MIDIData]]] - the consolidated key of each MIDI file,
+                with its memory-mapped stacked pianoroll, or its loaded MIDIData if not stacked yet
+
+        Returns:
+            List[np.array] - memory-mapped stacked pianorolls for all MIDI files, see _stack_pianorolls
+        """
+        self._store.append(
+            stacked={key: self._stack_pianorolls(midi=entry) for key, entry in stacked if isinstance(entry, MIDIData)}
+        )
+
+        # the store is re-mapped by the append, so every MIDI gets a view of the new mapping
+        return [self._store.get(key=key) for key, _ in stacked]
+
     def validate_data(self):
         """
         Check if all MIDI data has necessary pianorolls for all instruments.
+        MIDI files in the consolidated store are already validated when they are consolidated.
 
         Parameters:
-            None - we check with this object's private variable, _midis and _instruments
+            None - we check with this object's private variable, _instrument_masks and _instruments
 
         Returns:
             None - we trigger an exception imediately when found an error
         """
+        required_mask = _instrument_mask(instruments=self._instruments)
 
-        for midi in self._midis:
-            for instrument in self._instruments:
-                if instrument in midi.get_instruments():
-                    continue
-                raise ValueError(f"Instrument {instrument.name} is missing in the MIDI of the dataset!")
+        # a single vectorized test over all MIDI files
+        invalid = (self._instrument_masks & required_mask) != required_mask
+        if not invalid.any():
+            return
+
+        instrument_mask = int(self._instrument_masks[np.argmax(invalid)])
+        missing_instruments = [
+            instrument
+            for instrument in self._instruments
+            if not instrument_mask & _instrument_mask(instruments=[instrument])
+        ]
+        names = ", ".join(instrument.name for instrument in missing_instruments)
+        raise ValueError(f"Instrument {names} is missing in the MIDI of the dataset!")
 
     def __len__(self):
         """
         Returns:
             int - The length of this dataset
         """
-        return len(self._midis)
+        return len(self._paths)
 
     def __getitem__(self, index: int) -> np.array:
         """
@@ -272,6 +875,20 @@ class MIDIDataset(Dataset):
         Returns:
             np.array - A pianoroll np.array with the shape of [time, pitch, # instruments]
         """
-        pianorolls = [self._midis[index].get_pianoroll(instrument=instrument) for instrument in self._instruments]
-
-        return np.stack(pianorolls, axis=2)
+        if self._stacked is None:
+            midi = MIDIData(
+                midi_path=self._paths[index],
+                cache_home=self._cache_home,
+                binary=self._binary,
+                downsample=self._downsample,
+                instruments=set(self._instruments),
+            )
+            stacked = self._stack_pianorolls(midi=midi)
+        else:
+            stacked = self._stacked[index]
+
+        if self._binary:
+            # only the item served is unpacked, while the stacks and the consolidated store keep the packed bits
+            return np.unpackbits(stacked, axis=1, count=128).view(np.bool_)
+
+        return stacked
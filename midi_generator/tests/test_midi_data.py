@@ -1,9 +1,14 @@
 """Pytest for midis dataset"""
+import glob
+import os
+import shutil
 from tempfile import TemporaryDirectory
 from typing import List
 
 import numpy as np
+import pypianoroll
 
+from midi_generator.dataset import midi as midi_module
 from midi_generator.dataset.midi import MIDIData, MIDIDataset
 
 
@@ -42,6 +47,152 @@ def test_mididata(fxt_midi_files: List[str]):
             assert pianoroll.shape[-1] == 128
 
 
+def test_mididata_independent_pianorolls(fxt_midi_files: List[str]):
+    """
+    Test if modifying the pianoroll of a MIDIData does not leak to another MIDIData of the same MIDI file
+
+    Parameters:
+        midi_files: List[str] - list of path to MIDI file
+
+    Returns:
+        None
+    """
+    midi_path = fxt_midi_files[0]
+    midi = MIDIData(midi_path=midi_path)
+    instrument = midi.get_instruments()[0]
+    expected = midi.get_pianoroll(instrument=instrument).copy()
+
+    midi.get_pianoroll(instrument=instrument)[:] = 0
+    assert (MIDIData(midi_path=midi_path).get_pianoroll(instrument=instrument) == expected).all()
+
+
+def test_mididata_binary(fxt_midi_files: List[str]):
+    """
+    Test if binary MIDIData keeps only whether each note is on
+
+    Parameters:
+        midi_files: List[str] - list of path to MIDI file
+
+    Returns:
+        None
+    """
+    for midi_path in fxt_midi_files:
+        midi = MIDIData(midi_path=midi_path)
+        binary_midi = MIDIData(midi_path=midi_path, binary=True)
+
+        assert midi.get_instruments() == binary_midi.get_instruments()
+        for instrument in midi.get_instruments():
+            assert midi.get_pianoroll(instrument=instrument).dtype == np.uint8
+            assert binary_midi.get_pianoroll(instrument=instrument).dtype == np.bool_
+            assert (
+                binary_midi.get_pianoroll(instrument=instrument) == (midi.get_pianoroll(instrument=instrument) > 0)
+            ).all()
+
+            # 128 pitches are packed into 16 bytes for each time step
+            packed_pianoroll = binary_midi.get_packed_pianoroll(instrument=instrument)
+            assert packed_pianoroll.shape == (midi.get_pianoroll(instrument=instrument).shape[0], 16)
+            assert (packed_pianoroll == midi.get_packed_pianoroll(instrument=instrument)).all()
+
+
+def test_mididata_downsample():
+    """
+    Test if downsampled MIDIData keeps the maximum velocity over each window of time steps
+
+    Returns:
+        None
+    """
+    pianoroll = np.zeros((10, 128), dtype=np.uint8)
+    pianoroll[1, 60] = 100
+    pianoroll[2, 60] = 80
+    pianoroll[9, 64] = 50
+    track = pypianoroll.StandardTrack(program=0, pianoroll=pianoroll)
+
+    midi = MIDIData(multi_track=pypianoroll.Multitrack(tracks=[track]), downsample=4)
+    downsampled = midi.get_pianoroll(instrument=MIDIData.INSTRUMENT.PIANO)
+    assert downsampled.shape == (3, 128)
+    assert downsampled[0, 60] == 100
+    assert downsampled[2, 64] == 50
+    assert downsampled.sum() == 150
+
+    binary_midi = MIDIData(multi_track=pypianoroll.Multitrack(tracks=[track]), binary=True, downsample=4)
+    assert (binary_midi.get_pianoroll(instrument=MIDIData.INSTRUMENT.PIANO) == (downsampled > 0)).all()
+
+
+def test_midi_dataset_invalid_downsample(fxt_midi_files: List[str]):
+    """
+    Test if MIDIData and MIDIDataset raise an exception when downsample is not a positive integer
+
+    Parameters:
+        midi_files: List[str] - list of path to MIDI file
+    """
+    for downsample in [0, -2]:
+        exception_detected = False
+        try:
+            MIDIData(midi_path=fxt_midi_files[0], downsample=downsample)
+        except ValueError:
+            exception_detected = True
+        assert exception_detected
+
+        exception_detected = False
+        try:
+            MIDIDataset(midi_files=fxt_midi_files, instruments=[MIDIData.INSTRUMENT.PIANO], downsample=downsample)
+        except ValueError:
+            exception_detected = True
+        assert exception_detected
+
+
+def test_mididata_instrument_of_program():
+    """
+    Test if every program is mapped to the INSTRUMENT covering 8 consecutive programs
+
+    Returns:
+        None
+    """
+    for program in range(128):
+        track = pypianoroll.StandardTrack(program=program, pianoroll=np.zeros((16, 128), dtype=np.uint8))
+        midi = MIDIData(multi_track=pypianoroll.Multitrack(tracks=[track]))
+
+        assert midi.get_instruments() == [MIDIData.INSTRUMENT(program // 8 + 1)]
+
+
+def test_mididata_instruments():
+    """
+    Test if only the given instruments are extracted
+
+    Returns:
+        None
+    """
+    # 2 beats of the middle C
+    pianoroll = np.zeros((48, 128), dtype=np.uint8)
+    pianoroll[:, 60] = 100
+    tracks = [
+        pypianoroll.StandardTrack(program=0, pianoroll=pianoroll),
+        pypianoroll.StandardTrack(program=64, pianoroll=pianoroll),
+    ]
+    multi_track = pypianoroll.Multitrack(tracks=tracks)
+
+    midi = MIDIData(multi_track=multi_track, instruments={MIDIData.INSTRUMENT.PIANO})
+    assert midi.get_instruments() == [MIDIData.INSTRUMENT.PIANO]
+
+    midi = MIDIData(multi_track=multi_track)
+    assert midi.get_instruments() == [MIDIData.INSTRUMENT.PIANO, MIDIData.INSTRUMENT.REED]
+
+    # the instruments to be extracted are part of the cache key,
+    # so the cache of PIANO only is not served to the MIDIData of all instruments
+    with TemporaryDirectory() as cache_home:
+        midi_path = os.path.join(cache_home, "piano_and_reed.mid")
+        multi_track.write(midi_path)
+
+        midi = MIDIData(midi_path=midi_path, cache_home=cache_home, instruments={MIDIData.INSTRUMENT.PIANO})
+        assert midi.get_instruments() == [MIDIData.INSTRUMENT.PIANO]
+
+        midi = MIDIData(midi_path=midi_path, cache_home=cache_home)
+        assert midi.get_instruments() == [MIDIData.INSTRUMENT.PIANO, MIDIData.INSTRUMENT.REED]
+
+        midi = MIDIData(midi_path=midi_path, cache_home=cache_home, instruments={MIDIData.INSTRUMENT.PIANO})
+        assert midi.get_instruments() == [MIDIData.INSTRUMENT.PIANO]
+
+
 # pylint: disable=protected-access
 def test_mididata_pianorolls_cache(fxt_midi_files: List[str]):
     """
@@ -59,7 +210,8 @@ def test_mididata_pianorolls_cache(fxt_midi_files: List[str]):
             midi = MIDIData(midi_path=midi_path, cache_home=cache_home)
 
             # pianorolls for midi has to be cached from the previous MIDIData __init__ function
-            assert midi._try_pianorolls_from_cache(midi_path=midi_path, cache_home=cache_home) is not None
+            cache_path = midi._get_cache_path(midi_path=midi_path, cache_home=cache_home)
+            assert midi._try_pianorolls_from_cache(cache_path=cache_path) is not None
 
             # load MIDI from the cache
             midi2 = MIDIData(midi_path=midi_path, cache_home=cache_home)
@@ -69,7 +221,65 @@ def test_mididata_pianorolls_cache(fxt_midi_files: List[str]):
             assert len(midi.get_instruments()) == len(midi2.get_instruments())
 
             for instrument in midi.get_instruments():
-                assert (midi._pianorolls[instrument] == midi2._pianorolls[instrument]).all()
+                assert (midi.get_pianoroll(instrument=instrument) == midi2.get_pianoroll(instrument=instrument)).all()
+
+
+# pylint: disable=protected-access
+def test_mididata_pianorolls_cache_invalidation(fxt_midi_files: List[str]):
+    """
+    Test if the pianorolls cache of MIDIData is invalidated when the MIDI file is modified
+
+    Parameters:
+        midi_files: List[str] - list of path to MIDI file
+
+    Returns:
+        None
+    """
+
+    with TemporaryDirectory() as cache_home:
+        midi_path = shutil.copy(fxt_midi_files[0], cache_home)
+        midi = MIDIData(midi_path=midi_path, cache_home=cache_home)
+        cache_path = midi._get_cache_path(midi_path=midi_path, cache_home=cache_home)
+        assert midi._try_pianorolls_from_cache(cache_path=cache_path) is not None
+
+        # the modified MIDI file is keyed to another cache path
+        stat = os.stat(midi_path)
+        os.utime(midi_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        cache_path = midi._get_cache_path(midi_path=midi_path, cache_home=cache_home)
+        assert midi._try_pianorolls_from_cache(cache_path=cache_path) is None
+
+
+def test_midi_dataset_damaged_pianorolls_cache(fxt_midi_files: List[str]):
+    """
+    Test if MIDIDataset extracts the pianorolls again when the pianorolls caches of MIDIData are truncated
+
+    Parameters:
+        midi_files: List[str] - list of path to MIDI file
+    """
+    instruments = [MIDIData.INSTRUMENT.PIANO]
+    dataset = MIDIDataset(midi_files=fxt_midi_files, instruments=instruments)
+
+    with TemporaryDirectory() as cache_home:
+        MIDIDataset(midi_files=fxt_midi_files, instruments=instruments, cache_home=cache_home, lazy=True)
+
+        for size in [0, 3, 20, 300]:
+            for lazy in [False, True]:
+                for cache_path in glob.glob(os.path.join(cache_home, "*.blosc")):
+                    os.truncate(cache_path, size)
+                # the consolidated store would serve the eager dataset without reading the pianorolls caches
+                for consolidated_path in glob.glob(os.path.join(cache_home, "consolidated.*")):
+                    os.remove(consolidated_path)
+
+                cached_dataset = MIDIDataset(
+                    midi_files=fxt_midi_files, instruments=instruments, cache_home=cache_home, lazy=lazy
+                )
+
+                assert len(cached_dataset) == len(dataset)
+                for midi, cached_midi in zip(dataset, cached_dataset):
+                    assert (midi == cached_midi).all()
+
+        # the pianorolls caches are replaced atomically, so no temporary file is left
+        assert not glob.glob(os.path.join(cache_home, "*.tmp"))
 
 
 def test_midi_dataset(fxt_midi_files: List[str]):
@@ -106,3 +316,116 @@ def test_midi_dataset_missing_instrument(fxt_midi_files: List[str]):
         exception_detected = True
 
     assert exception_detected
+
+
+def test_midi_dataset_consolidated_cache(fxt_midi_files: List[str]):
+    """
+    Test if MIDIDataset serves the same pianorolls from the consolidated cache
+
+    Parameters:
+        midi_files: List[str] - list of path to MIDI file
+    """
+    instruments = [MIDIData.INSTRUMENT.PIANO]
+    dataset = MIDIDataset(midi_files=fxt_midi_files, instruments=instruments)
+
+    with TemporaryDirectory() as cache_home:
+        data_path = os.path.join(cache_home, "consolidated.bin")
+
+        # the first build writes the consolidated cache, and the second build memory-maps it
+        for _ in range(2):
+            cached_dataset = MIDIDataset(midi_files=fxt_midi_files, instruments=instruments, cache_home=cache_home)
+
+            assert len(cached_dataset) == len(dataset)
+            for midi, cached_midi in zip(dataset, cached_dataset):
+                assert isinstance(cached_midi, np.memmap)
+                assert os.path.samefile(cached_midi.filename, data_path)
+                assert midi.shape == cached_midi.shape
+                assert (midi == cached_midi).all()
+
+        # a truncated, emptied or missing data file falls back to rebuild the consolidated cache
+        for size in [1000, 0, None]:
+            if size is None:
+                os.remove(data_path)
+            else:
+                os.truncate(data_path, size)
+
+            cached_dataset = MIDIDataset(midi_files=fxt_midi_files, instruments=instruments, cache_home=cache_home)
+
+            assert len(cached_dataset) == len(dataset)
+            for midi, cached_midi in zip(dataset, cached_dataset):
+                assert os.path.samefile(cached_midi.filename, data_path)
+                assert (midi == cached_midi).all()
+
+
+# pylint: disable=protected-access
+def test_consolidated_store_append():
+    """
+    Test if the consolidated stores sharing a cache home keep the pianorolls appended by each other
+
+    Returns:
+        None
+    """
+    with TemporaryDirectory() as cache_home:
+        store = midi_module._ConsolidatedStore(cache_home=cache_home)
+        other_store = midi_module._ConsolidatedStore(cache_home=cache_home)
+
+        pianoroll = np.arange(12, dtype=np.uint8).reshape(2, 3, 2)
+        other_pianoroll = np.ones((4, 3, 1), dtype=np.bool_)
+        store.append(stacked={"a": pianoroll})
+        # other_store is opened before the append of store, but it must not overwrite the entry of store
+        other_store.append(stacked={"b": other_pianoroll})
+
+        reopened_store = midi_module._ConsolidatedStore(cache_home=cache_home)
+        assert (reopened_store.get(key="a") == pianoroll).all()
+        assert (reopened_store.get(key="b") == other_pianoroll).all()
+        assert reopened_store.get(key="c") is None
+
+
+# pylint: disable=protected-access
+def test_midi_dataset_binary(fxt_midi_files: List[str]):
+    """
+    Test if a binary MIDIDataset serves note on/off of the pianorolls, while stacking them packed along pitch
+
+    Parameters:
+        midi_files: List[str] - list of path to MIDI file
+    """
+    instruments = [MIDIData.INSTRUMENT.PIANO]
+    dataset = MIDIDataset(midi_files=fxt_midi_files, instruments=instruments)
+
+    with TemporaryDirectory() as cache_home:
+        binary_datasets = [
+            MIDIDataset(midi_files=fxt_midi_files, instruments=instruments, binary=True),
+            MIDIDataset(midi_files=fxt_midi_files, instruments=instruments, binary=True, lazy=True),
+        ]
+        # the first build writes the consolidated cache, and the second build memory-maps it
+        for _ in range(2):
+            binary_datasets.append(
+                MIDIDataset(midi_files=fxt_midi_files, instruments=instruments, binary=True, cache_home=cache_home)
+            )
+
+        for binary_dataset in binary_datasets:
+            assert len(binary_dataset) == len(dataset)
+            for midi, binary_midi in zip(dataset, binary_dataset):
+                assert binary_midi.dtype == np.bool_
+                assert (binary_midi == (midi > 0)).all()
+
+            if binary_dataset._stacked is not None:
+                for packed_midi in binary_dataset._stacked:
+                    assert packed_midi.dtype == np.uint8
+                    assert packed_midi.shape[1:] == (16, len(instruments))
+
+
+def test_midi_dataset_lazy(fxt_midi_files: List[str]):
+    """
+    Test if a lazy MIDIDataset serves the same pianorolls with the eager one
+
+    Parameters:
+        midi_files: List[str] - list of path to MIDI file
+    """
+    instruments = [MIDIData.INSTRUMENT.PIANO]
+    dataset = MIDIDataset(midi_files=fxt_midi_files, instruments=instruments)
+    lazy_dataset = MIDIDataset(midi_files=fxt_midi_files, instruments=instruments, lazy=True)
+
+    assert len(lazy_dataset) == len(dataset)
+    for midi, lazy_midi in zip(dataset, lazy_dataset):
+        assert (midi == lazy_midi).all()
@@ -5,45 +5,50 @@ import logging
 class Log:
     """
     Log keeps a single static logger variable to print all logs from everywhere
+
+    Messages are formatted lazily in %-style by logging, only when the level of the message is enabled.
     """
 
-    logger = logging.getLogger()
+    logger = logging.getLogger("midi_generator")
 
     @staticmethod
-    def info(msg: str):
+    def info(msg: str, *args):
         """
         Print info message
 
         Parameters:
-            msg: str - message to print
+            msg: str - message to print, formatted with args in %-style
+            args: Any - arguments of the message
 
         Returns:
             None
         """
-        Log.logger.info(msg)
+        Log.logger.info(msg, *args)
 
     @staticmethod
-    def warning(msg: str):
+    def warning(msg: str, *args):
         """
         Print warning message
 
         Parameters:
-            msg: str - message to print
+            msg: str - message to print, formatted with args in %-style
+            args: Any - arguments of the message
 
         Returns:
             None
         """
-        Log.logger.warning(msg)
+        Log.logger.warning(msg, *args)
 
     @staticmethod
-    def error(msg: str):
+    def error(msg: str, *args):
         """
         Print error message
 
         Parameters:
-            msg: str - message to print
+            msg: str - message to print, formatted with args in %-style
+            args: Any - arguments of the message
 
         Returns:
             None
         """
-        Log.logger.error(msg)
+        Log.logger.error(msg, *args)